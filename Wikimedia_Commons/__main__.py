@@ -1,9 +1,15 @@
 from logging import INFO, basicConfig
 from .main import parser as _parser
-from asyncio import run as _run
+from asyncio import Runner as _Runner
 from sys import argv as _argv
 
+try:
+    from uvloop import new_event_loop as _new_event_loop
+except ImportError:
+    _new_event_loop = None
+
 if __name__ == "__main__":
     basicConfig(level=INFO)
     entry = _parser().parse_args(_argv[1:])
-    _run(entry.invoke(entry))
+    with _Runner(loop_factory=_new_event_loop) as runner:
+        runner.run(entry.invoke(entry))
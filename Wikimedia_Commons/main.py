@@ -4,40 +4,81 @@ from .. import (
     USER_AGENT as _U_AG,
     VERSION as _VER,
 )
-from aiohttp import ClientSession as _CliSess, TCPConnector as _TCPConn
-from anyio import Path as _Path
+from aiohttp import (
+    ClientConnectionError as _CliConnErr,
+    ClientResponse as _CliResp,
+    ClientSession as _CliSess,
+    TCPConnector as _TCPConn,
+)
+from aiohttp.http_parser import HAS_BROTLI as _HAS_BROTLI
+from anyio import AsyncFile as _AsyncFile, Path as _Path
+from anyio.to_thread import run_sync as _run_sync
 from argparse import (
     ArgumentParser as _ArgParser,
+    ArgumentTypeError as _ArgTypeErr,
     Namespace as _NS,
     ONE_OR_MORE as _ONE_OR_MORE,
 )
-from asyncio import create_task, gather as _gather
+from asyncio import Semaphore as _Sem, create_task, gather as _gather, sleep as _sleep
+from collections import defaultdict as _defaultdict
+from contextlib import suppress as _suppress
 from dataclasses import dataclass as _dc
 from enum import IntFlag as _IntFlag, auto as _auto, unique as _unq
 from functools import partial as _part, wraps as _wraps
 from html2text import HTML2Text as _HTM2TXT
-from itertools import chain as _chain
-from json import loads as _loads
-from re import MULTILINE as _MULTILINE, compile as _re_comp
+from re import compile as _re_comp
 from sys import exit as _exit
-from types import SimpleNamespace as _SimpNS
 from typing import (
+    Awaitable as _Await,
     Callable as _Call,
     ClassVar as _ClsVar,
-    Generic as _Generic,
     Iterable as _Iter,
+    Iterator as _Itor,
     Mapping as _Map,
-    Protocol as _Proto,
     Sequence as _Seq,
+    TypedDict as _TDict,
     TypeVar as _TVar,
     final as _fin,
 )
 from urllib.parse import unquote as _pct_unesc, quote as _pct_esc
 from yarl import URL as _URL
 
-_MAX_CONCURRENT_REQUESTS_PER_HOST = 1
+try:
+    from orjson import loads as _loads
+except ImportError:
+    from json import loads as _loads
+try:
+    from os import posix_fallocate as _fallocate
+except ImportError:
+    _fallocate = None
+
+_ACCEPT_ENCODING = "br, gzip" if _HAS_BROTLI else "gzip"
+_API_URL = _URL.build(
+    scheme="https",
+    host="commons.wikimedia.org",
+    path="/w/api.php",
+    query={
+        "format": "json",
+        "action": "query",
+        "prop": "imageinfo",
+        "iiprop": "extmetadata|url",
+    },
+)
+_DNS_CACHE_TTL = 300
+_FETCH_CHUNK_SIZE = 1 << 20
+_INDEX_ESCAPE_TABLE = str.maketrans({"\\": "\\\\", "]": "\\]"})
+_MAX_CONCURRENT_REQUESTS_PER_HOST = 8
 _PERCENT_ESCAPE_SAFE = "/,"
 _QUERY_LIMIT = 50
+_RETRY_BACKOFF = 0.5
+_RETRY_LIMIT = 3
+# plain text, optionally in a single link, that `HTML2Text` would output as is
+_SIMPLE_AUTHOR_PATTERN = _re_comp(
+    r"(?:<a\b[^<>]*>)?([^\W\d_](?: ?[\w,.'()+-]){0,63})(?:</a>)?"
+)
+_UNKNOWN_AUTHOR = "Unknown author".casefold()
+_UNKNOWN_LICENSE = "Unknown license".casefold()
+
 _T = _TVar("_T")
 
 
@@ -68,115 +109,100 @@ class Args:
     inputs: _Seq[str]
     dest: _Path
     index: _Path | None
+    max_concurrency: int = _MAX_CONCURRENT_REQUESTS_PER_HOST
 
     def __post_init__(self):
         object.__setattr__(self, "inputs", tuple(self.inputs))
+        if self.max_concurrency < 1:
+            raise ValueError(f"max_concurrency must be >= 1: {self.max_concurrency}")
 
 
 @_fin
-class _JSONDict(_SimpNS, _Generic[_T]):
-    __slots__: _ClsVar = ()
-
-    def __init__(self, dict: _Map[str, _T]):
-        super().__init__(**dict)
-
-    def __getattr__(self, name: str):
-        try:
-            return getattr(self.__dict__, name)
-        except AttributeError:
-            return None
-
-    def __getitem__(self, key: str):
-        return getattr(self, key)
+class _Value(_TDict):
+    value: str
+    source: str
 
 
 @_fin
-class _Response(_Proto):
-    __slots__: _ClsVar = ()
-
-    @_fin
-    class Value(_Proto):
-        __slots__: _ClsVar = ()
-
-        @property
-        def value(self) -> str: ...
-
-        @property
-        def source(self) -> str: ...
-
-    @_fin
-    class ExtMetadata(_Proto):
-        __slots__: _ClsVar = ()
+class _ExtMetadata(_TDict, total=False):
+    Artist: _Value
+    LicenseShortName: _Value
+    LicenseUrl: _Value
 
-        @property
-        def Artist(self) -> "_Response.Value | None": ...
 
-        @property
-        def LicenseShortName(self) -> "_Response.Value | None": ...
-
-        @property
-        def LicenseUrl(self) -> "_Response.Value | None": ...
-
-    @_fin
-    class ImageInfoEntry(_Proto):
-        __slots__: _ClsVar = ()
-
-        @property
-        def descriptionurl(self) -> str: ...
-
-        @property
-        def extmetadata(self) -> "_Response.ExtMetadata": ...
-
-        @property
-        def url(self) -> str: ...
-
-    @_fin
-    class Page(_Proto):
-        __slots__: _ClsVar = ()
-
-        @property
-        def title(self) -> str: ...
+@_fin
+class _ImageInfoEntry(_TDict):
+    descriptionurl: str
+    extmetadata: _ExtMetadata
+    url: str
 
-        @property
-        def imageinfo(self) -> "_Seq[_Response.ImageInfoEntry]": ...
 
-    @_fin
-    class Query(_Proto):
-        __slots__: _ClsVar = ()
+@_fin
+class _Page(_TDict):
+    title: str
+    imageinfo: _Seq[_ImageInfoEntry]
 
-        @property
-        def pages(self) -> "_Map[str, _Response.Page]": ...
 
-    query: Query
+@_fin
+class _Query(_TDict):
+    pages: _Map[str, _Page]
 
 
-_INDEX_FORMAT_PATTERN = _re_comp(
-    r"^- \[(.+?(?<!\\))]\((.+?(?<!\\))\): (.+)$", _MULTILINE
-)
+@_fin
+class _Response(_TDict):
+    query: _Query
+
+
+def _index_parser(paragraph: str) -> _Itor[tuple[str, str]]:
+    for line in paragraph.split("\n"):
+        if not line.startswith("- ["):
+            continue
+        label_end = line.find("](", 4)
+        while label_end >= 0:
+            if line[label_end - 1] != "\\":
+                link_end = line.find("): ", label_end + 3)
+                while link_end >= 0 and (
+                    line[link_end - 1] == "\\" or link_end + 3 >= len(line)
+                ):
+                    link_end = line.find("): ", link_end + 1)
+                if link_end >= 0:
+                    yield _pct_unesc(line[label_end + 2 : link_end]), line
+                    break
+            label_end = line.find("](", label_end + 1)
 
 
 def _index_formatter(filename: str, credit: str):
-    escaped = filename.replace("\\", "\\\\").replace("]", "\\]")
+    escaped = filename.translate(_INDEX_ESCAPE_TABLE)
     return f"- [{escaped}]({_pct_esc(filename, safe=_PERCENT_ESCAPE_SAFE)}): {credit}"
 
 
-def _credit_formatter(page: _Response.Page):
+def _author_formatter(html: str):
+    simple = _SIMPLE_AUTHOR_PATTERN.fullmatch(html.strip())
+    if simple:
+        return simple[1]
+
     htm_esc = _HTM2TXT()
     htm_esc.emphasis_mark = "_"
     htm_esc.ignore_links = True
     htm_esc.single_line_break = True
     htm_esc.strong_mark = "__"
     htm_esc.ul_item_mark = "-"
+    return htm_esc.handle(html).strip()
+
 
-    ii = page.imageinfo[0]
-    emd = ii.extmetadata
-    author = htm_esc.handle(emd.Artist.value).strip() if emd.Artist else ""
-    if "Unknown author".casefold() in author.casefold():
+def _credit_formatter(page: _Page):
+    ii = page["imageinfo"][0]
+    emd = ii["extmetadata"]
+    artist = emd.get("Artist")
+    author = _author_formatter(artist["value"]) if artist else ""
+    if _UNKNOWN_AUTHOR in author.casefold():
         author = ""
-    lic = emd.LicenseShortName.value if emd.LicenseShortName else ""
-    if "Unknown license".casefold() in lic.casefold():
+    lic_name = emd.get("LicenseShortName")
+    lic = lic_name["value"] if lic_name else ""
+    if _UNKNOWN_LICENSE in lic.casefold():
         lic = ""
-    lic_url = emd.LicenseUrl.value if lic and emd.LicenseUrl else ""
+    lic_url_val = emd.get("LicenseUrl")
+    lic_url = lic_url_val["value"] if lic and lic_url_val else ""
     lic_lnk = "".join(
         (
             f'<a href="{lic_url}">' if lic_url else "",
@@ -185,9 +211,42 @@ def _credit_formatter(page: _Response.Page):
         )
     )
     author = author.replace("\n", "") or "See page for author"
-    return (
-        f'<a href="{ii.descriptionurl}">{author}</a>, {lic_lnk}, via Wikimedia Commons'
-    )
+    return f'<a href="{ii["descriptionurl"]}">{author}</a>, {lic_lnk}, via Wikimedia Commons'
+
+
+async def _retry(func: _Call[[], _Await[_T]], description: str):
+    for attempt in range(1, _RETRY_LIMIT):
+        try:
+            return await func()
+        except (TimeoutError, _CliConnErr) as exc:
+            delay = _RETRY_BACKOFF * 2 ** (attempt - 1)
+            _LOGGER.warning(
+                f"Retrying {description} in {delay} s "
+                f"(attempt {attempt}/{_RETRY_LIMIT}): {exc!r}"
+            )
+            await _sleep(delay)
+    return await func()
+
+
+async def _write_response(resp: _CliResp, file: _AsyncFile[bytes]):
+    # `Content-Length` is the encoded size if there is `Content-Encoding`
+    size = None if "Content-Encoding" in resp.headers else resp.content_length
+    if size is not None and size <= _FETCH_CHUNK_SIZE:
+        await file.write(await resp.read())
+        return
+    if _fallocate is not None and size:
+        with _suppress(OSError):
+            await _run_sync(_fallocate, file.wrapped.fileno(), 0, size)
+
+    write = None
+    try:
+        async for chunk in resp.content.iter_chunked(_FETCH_CHUNK_SIZE):
+            if write is not None:
+                await write
+            write = create_task(file.write(chunk))
+    finally:
+        if write is not None:
+            await write
 
 
 async def main(args: Args):
@@ -196,44 +255,43 @@ async def main(args: Args):
     try:
         inputs = tuple(dict.fromkeys(args.inputs))
         async with _CliSess(
-            connector=_TCPConn(limit_per_host=_MAX_CONCURRENT_REQUESTS_PER_HOST),
+            connector=_TCPConn(
+                limit=0,
+                limit_per_host=args.max_concurrency,
+                ttl_dns_cache=_DNS_CACHE_TTL,
+            ),
             headers={
-                "Accept-Encoding": "gzip",
+                "Accept-Encoding": _ACCEPT_ENCODING,
                 "User-Agent": _U_AG,
             },
         ) as sess:
+            request_limits = _defaultdict[str | None, _Sem](
+                _part(_Sem, args.max_concurrency)
+            )
             try:
                 _LOGGER.info(f"Querying {len(inputs)} files")
 
                 async def query(inputs: _Iter[str]):
-                    async with sess.get(
-                        _URL.build(
-                            scheme="https",
-                            host="commons.wikimedia.org",
-                            path="/w/api.php",
-                            query={
-                                "format": "json",
-                                "action": "query",
-                                "titles": "|".join(inputs),
-                                "prop": "imageinfo",
-                                "iiprop": "extmetadata|url",
-                            },
-                        )
-                    ) as resp:
-                        data: _Response = await resp.json(
-                            loads=_part(_loads, object_hook=_JSONDict)
-                        )
-                    return data.query.pages.items()
-
-                queries: _Seq[_Iter[tuple[str, _Response.Page]]] = await _gather(
-                    *map(
-                        lambda idx: query(inputs[idx : idx + _QUERY_LIMIT]),
-                        range(0, len(inputs), _QUERY_LIMIT),
-                    )
+                    url = _API_URL.update_query(titles="|".join(inputs))
+
+                    async def query0():
+                        async with request_limits[url.host], sess.get(url) as resp:
+                            data: _Response = _loads(await resp.read())
+                        return data["query"]["pages"].items()
+
+                    return await _retry(query0, "querying")
+
+                batches = (
+                    inputs[idx : idx + _QUERY_LIMIT]
+                    for idx in range(0, len(inputs), _QUERY_LIMIT)
                 )
-                pages = tuple(
-                    {id: page for id, page in _chain.from_iterable(queries)}.values()
+                queries: _Seq[_Iter[tuple[str, _Page]]] = await _gather(
+                    *map(query, batches)
                 )
+                pages_by_id = dict[str, _Page]()
+                for query_pages in queries:
+                    pages_by_id.update(query_pages)
+                pages = tuple(pages_by_id.values())
             except Exception:
                 _LOGGER.exception("Error querying")
                 ec |= ExitCode.QUERY_ERROR
@@ -241,15 +299,30 @@ async def main(args: Args):
             try:
                 _LOGGER.info(f"Fetching {len(pages)} files")
 
-                async def fetch(page: _Response.Page):
-                    filename = page.title.split(":", 1)[-1]
-                    async with (
-                        sess.get(page.imageinfo[0].url) as resp,
-                        await (args.dest / filename).open(mode="wb") as file,
-                    ):
-                        _LOGGER.info(f"Fetching '{filename}'")
-                        async for chunk in resp.content.iter_any():
-                            await file.write(chunk)
+                async def fetch(page: _Page):
+                    namespace, sep, filename = page["title"].partition(":")
+                    if not sep:
+                        filename = namespace
+
+                    url = _URL(page["imageinfo"][0]["url"])
+                    dest = args.dest / filename
+                    temp = dest.with_name(f"{dest.name}.tmp")
+
+                    async def fetch0():
+                        try:
+                            async with (
+                                request_limits[url.host],
+                                sess.get(url) as resp,
+                                await temp.open(mode="wb") as file,
+                            ):
+                                _LOGGER.info(f"Fetching '{filename}'")
+                                await _write_response(resp, file)
+                            await temp.replace(dest)
+                        except BaseException:
+                            await temp.unlink(missing_ok=True)
+                            raise
+
+                    await _retry(fetch0, f"fetching '{filename}'")
                     return filename, _index_formatter(filename, _credit_formatter(page))
 
                 entries: _Seq[tuple[str, str]] = await _gather(*map(fetch, pages))
@@ -265,39 +338,30 @@ async def main(args: Args):
 
                     await args.index.parent.mkdir(parents=True, exist_ok=True)
                     try:
-                        file = await args.index.open(mode="xt", **_OPEN_TXT_OPTS)
-                    except FileExistsError:
-                        pass
-                    else:
-                        await file.aclose()
-
-                    async with await args.index.open(
-                        mode="r+t", **_OPEN_TXT_OPTS
-                    ) as file:
-                        read = await file.read()
-                        seek = create_task(file.seek(0))
-                        try:
-                            paragraphs = read.strip().split("\n\n")
-                            index = {
-                                _pct_unesc(match[2]): match[0]
-                                for match in _INDEX_FORMAT_PATTERN.finditer(
-                                    paragraphs[-1]
-                                )
-                            }
-                            for filename, entry in entries:
-                                index[filename] = entry
-                            paragraphs[-1] = "\n".join(
-                                value
-                                for _, value in sorted(
-                                    index.items(), key=lambda item: item[0]
-                                )
-                            )
-                            text = "\n\n".join(paragraphs) + "\n"
-                            await seek
+                        async with await args.index.open(
+                            mode="rt", **_OPEN_TXT_OPTS
+                        ) as file:
+                            read = await file.read()
+                    except FileNotFoundError:
+                        read = ""
+
+                    paragraphs = read.strip().split("\n\n")
+                    index = dict(_index_parser(paragraphs[-1]))
+                    for filename, entry in entries:
+                        index[filename] = entry
+                    paragraphs[-1] = "\n".join(
+                        index[filename] for filename in sorted(index)
+                    )
+                    text = "\n\n".join(paragraphs) + "\n"
+
+                    temp = args.index.with_name(f"{args.index.name}.tmp")
+                    try:
+                        async with await temp.open(mode="wt", **_OPEN_TXT_OPTS) as file:
                             await file.write(text)
-                            await file.truncate()
-                        finally:
-                            seek.cancel()
+                        await temp.replace(args.index)
+                    except BaseException:
+                        await temp.unlink(missing_ok=True)
+                        raise
             except Exception:
                 _LOGGER.exception("Error indexing")
                 ec |= ExitCode.INDEX_ERROR
@@ -309,6 +373,16 @@ async def main(args: Args):
     _exit(ec)
 
 
+def _positive_int(value: str):
+    try:
+        ret = int(value)
+    except ValueError as exc:
+        raise _ArgTypeErr(f"invalid int value: {value!r}") from exc
+    if ret < 1:
+        raise _ArgTypeErr(f"must be >= 1: {ret}")
+    return ret
+
+
 def parser(parent: _Call[..., _ArgParser] | None = None):
     prog = __package__ or __name__
 
@@ -341,6 +415,14 @@ def parser(parent: _Call[..., _ArgParser] | None = None):
         type=_Path,
         help="Markdown-based index file",
     )
+    parser.add_argument(
+        "-c",
+        "--max-concurrency",
+        action="store",
+        type=_positive_int,
+        default=_MAX_CONCURRENT_REQUESTS_PER_HOST,
+        help="maximum number of concurrent requests per host",
+    )
     parser.add_argument(
         "inputs",
         action="store",
@@ -356,6 +438,7 @@ def parser(parent: _Call[..., _ArgParser] | None = None):
                 inputs=args.inputs,
                 dest=args.dest,
                 index=args.index,
+                max_concurrency=args.max_concurrency,
             )
         )
 
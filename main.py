@@ -1,15 +1,21 @@
 from . import VERSION as _VER
-from .Wikimedia_Commons import (
-    __name__ as _wm_c_name,
-    __package__ as _wm_c_package,
-    main as _wm_c_main,
-)
 from argparse import ArgumentParser as _ArgParser
 from functools import partial as _part
-from typing import Callable as _Call
+from importlib import import_module as _import
+from typing import Callable as _Call, Sequence as _Seq
 
+_SUBCOMMANDS = ("Wikimedia_Commons",)
 
-def parser(parent: _Call[..., _ArgParser] | None = None):
+
+def _sniff_subcommand(argv: _Seq[str]):
+    return next((arg for arg in argv if not arg.startswith("-")), None)
+
+
+def parser(
+    parent: _Call[..., _ArgParser] | None = None,
+    *,
+    argv: _Seq[str] | None = None,
+):
     prog = __package__ or __name__
 
     parser = (_ArgParser if parent is None else parent)(
@@ -29,9 +35,10 @@ def parser(parent: _Call[..., _ArgParser] | None = None):
     subparsers = parser.add_subparsers(
         required=True,
     )
-    _wm_c_main.parser(
-        _part(
-            subparsers.add_parser, (_wm_c_package or _wm_c_name).replace(f"{prog}.", "")
-        )
-    )
+    selected = None if argv is None else _sniff_subcommand(argv)
+    for name in _SUBCOMMANDS:
+        if argv is not None and name != selected:
+            subparsers.add_parser(name)
+            continue
+        _import(f".{name}.main", __package__).parser(_part(subparsers.add_parser, name))
     return parser